@@ -1,4 +1,4 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 """
 Script that parses a Spatial Transcriptimics (ST) data file generated
 with the pipeline in matrix (TSV) format where the genes are named
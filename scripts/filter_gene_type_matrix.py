@@ -1,4 +1,4 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 """ 
 Script that takes a matrix of counts
 where the columns are genes and the rows
@@ -1,4 +1,4 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 """ 
 Script that merges the FASTQ files present in an Illumina run folder path.
 The script merges the FASTQ files based on the indexes/identifiers given
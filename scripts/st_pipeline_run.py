@@ -1,4 +1,4 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 """ 
 ST Pipeline is a tool to process the Spatial Transcriptomics raw datasets.
 The data is filtered, aligned to a genome, annotated to a reference,
@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 """
 ST Pipeline is a tool to process Spatial Transcriptomics raw data (or 
 any type of single cell data whose raw data has the same configuraiton).
@@ -13,6 +13,7 @@ import os
 import io
 import glob
 import sys
+import platform
 from setuptools import setup, find_packages
 from stpipeline.version import version_number
 from distutils.core import setup, Extension
@@ -36,12 +37,25 @@ major, minor1, minor2, s, tmp = sys.version_info
 if major != 3 or minor1 < 6:
     raise SystemExit("ST Pipeline requires Python 3.6 or bigger")
 
+# The _bam_iter extension is compiled against the htslib headers and
+# libraries shipped with pysam so it must be installed before building
+try:
+    import pysam
+except ImportError:
+    raise SystemExit("ST Pipeline requires pysam to be installed before building "
+                     "(the _bam_iter extension links against its htslib), "
+                     "install it first with: pip install pysam")
+
 # setuptools DWIM monkey-patch madness
 # http://mail.python.org/pipermail/distutils-sig/2007-September/thread.html#8204
 # if 'setuptools.extension' in sys.modules:
 #    m = sys.modules['setuptools.extension']
 #    m.Extension.__dict__ = m._Extension.__dict__
 
+# Use the hardware popcount instruction in the UMI kernels when building on x86-64
+# (otherwise __builtin_popcountll is lowered to a libgcc call)
+umi_kernels_args = ['-mpopcnt'] if platform.machine() in ('x86_64', 'AMD64') else []
+
 setup(
     name='stpipeline',
     version=version_number,
@@ -55,6 +69,12 @@ setup(
     packages=find_packages(exclude=('tests*', 'utils', '*.pyx')),
     ext_modules=[
         Extension('stpipeline.common.cdistance', ['stpipeline/common/cdistance.pyx']),
+        Extension('stpipeline.common._umi_kernels', ['stpipeline/common/_umi_kernels.pyx'],
+                  extra_compile_args=umi_kernels_args),
+        Extension('stpipeline.common._bam_iter', ['stpipeline/common/_bam_iter.pyx'],
+                  include_dirs=pysam.get_include(),
+                  define_macros=pysam.get_defines(),
+                  extra_link_args=pysam.get_libraries()),
         Extension('stpipeline.common.unique_events_parser', ['stpipeline/common/unique_events_parser.pyx']),
         Extension('stpipeline.common.filterInputReads', ['stpipeline/common/filterInputReads.pyx'])
     ],
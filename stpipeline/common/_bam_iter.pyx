@@ -0,0 +1,135 @@
+#cython: language_level=3, boundscheck=False, wraparound=False
+"""
+Low level iteration of the records of a BAM file.
+The records are read directly from the htslib bam1_t structs
+(no AlignedSegment objects are created) and only the fields
+needed to create the dataset are extracted into NumPy arrays
+"""
+
+import sys
+import numpy as np
+from libc.stdint cimport int32_t, int64_t, uint8_t, uint32_t
+from pysam.libcalignmentfile cimport AlignmentFile
+from pysam.libchtslib cimport bam1_t, bam_init1, bam_destroy1, sam_read1, \
+    bam_aux_get, bam_aux2i, bam_aux2Z, bam_get_qname, bam_get_cigar, bam_endpos, \
+    bam_cigar_op, bam_cigar_oplen, BAM_CSOFT_CLIP, BAM_CHARD_CLIP, BAM_FREVERSE, BAM_FUNMAP
+
+# The number of records read into the arrays of each chunk
+RECORDS_CHUNK_SIZE = 100000
+
+cdef inline int aux_int(bam1_t * b, const char * tag, int default):
+    # Returns the value of an integer (or integer as string) tag
+    cdef uint8_t * value = bam_aux_get(b, tag)
+    if value == NULL:
+        return default
+    if value[0] == b'Z':
+        return int(bam_aux2Z(value))
+    return bam_aux2i(value)
+
+cdef inline str aux_str(bam1_t * b, const char * tag, str default):
+    # Returns the value of a string tag
+    cdef uint8_t * value = bam_aux_get(b, tag)
+    if value == NULL:
+        return default
+    if value[0] != b'Z':
+        return str(bam_aux2i(value))
+    return bam_aux2Z(value).decode()
+
+def iterate_records(AlignmentFile sam_file, int chunk_size=RECORDS_CHUNK_SIZE):
+    """
+    Iterates the records of a BAM file (from the current position to the end)
+    yielding them in chunks of parallel NumPy arrays (one entry per record)
+    :param sam_file: an open pysam.AlignmentFile
+    :param chunk_size: the maximum number of records of each chunk
+    :raises: ValueError if an unmapped record is found, IOError if the file cannot be read
+    :return: yields a dictionary with the arrays:
+             tid, position (reference start), start, end (accounting for soft-clipped
+             bases and swapped for the reverse strand), name (bytes), mapq, strand (0 forward, 1 reverse),
+             x, y (the B1 and B2 tags), gene (XF tag) and umi (B3 tag, interned)
+    """
+    cdef bam1_t * b = bam_init1()
+    cdef uint32_t * cigar
+    cdef uint32_t n_cigar, k, op
+    cdef int64_t start, end
+    cdef Py_ssize_t n
+    cdef int ret = 0
+    cdef int32_t[::1] tid_view, position_view, start_view, end_view, mapq_view, x_view, y_view
+    cdef signed char[::1] strand_view
+    try:
+        while True:
+            tid = np.empty(chunk_size, dtype=np.int32)
+            position = np.empty(chunk_size, dtype=np.int32)
+            starts = np.empty(chunk_size, dtype=np.int32)
+            ends = np.empty(chunk_size, dtype=np.int32)
+            mapq = np.empty(chunk_size, dtype=np.int32)
+            strand = np.empty(chunk_size, dtype=np.int8)
+            x = np.empty(chunk_size, dtype=np.int32)
+            y = np.empty(chunk_size, dtype=np.int32)
+            names = np.empty(chunk_size, dtype=object)
+            genes = np.empty(chunk_size, dtype=object)
+            umis = np.empty(chunk_size, dtype=object)
+            tid_view = tid
+            position_view = position
+            start_view = starts
+            end_view = ends
+            mapq_view = mapq
+            x_view = x
+            y_view = y
+            strand_view = strand
+            n = 0
+            while n < chunk_size:
+                ret = sam_read1(sam_file.htsfile, sam_file.header.ptr, b)
+                if ret < -1:
+                    raise IOError("Error reading the BAM file {}".format(sam_file.filename.decode()))
+                if ret == -1:
+                    break
+                # The annotated records must be mapped to a reference
+                if b.core.tid < 0 or b.core.flag & BAM_FUNMAP:
+                    raise ValueError("Unmapped record {} found in the BAM file {}".format(
+                        bam_get_qname(b).decode(), sam_file.filename.decode()))
+                # Account for soft-clipped bases when retrieving the start/end coordinates
+                cigar = bam_get_cigar(b)
+                n_cigar = b.core.n_cigar
+                start = b.core.pos
+                for k in range(n_cigar):
+                    op = bam_cigar_op(cigar[k])
+                    if op == BAM_CSOFT_CLIP:
+                        start -= bam_cigar_oplen(cigar[k])
+                    elif op != BAM_CHARD_CLIP:
+                        break
+                end = bam_endpos(b)
+                for k in range(n_cigar):
+                    op = bam_cigar_op(cigar[n_cigar - k - 1])
+                    if op == BAM_CSOFT_CLIP:
+                        end += bam_cigar_oplen(cigar[n_cigar - k - 1])
+                    elif op != BAM_CHARD_CLIP:
+                        break
+                tid_view[n] = b.core.tid
+                position_view[n] = b.core.pos
+                mapq_view[n] = b.core.qual
+                if b.core.flag & BAM_FREVERSE:
+                    # We swap start and end if the transcript mapped to the reverse strand
+                    start_view[n] = end
+                    end_view[n] = start
+                    strand_view[n] = 1
+                else:
+                    start_view[n] = start
+                    end_view[n] = end
+                    strand_view[n] = 0
+                # Get TAGGD tags from the record
+                x_view[n] = aux_int(b, b"B1", -1)
+                y_view[n] = aux_int(b, b"B2", -1)
+                genes[n] = aux_str(b, b"XF", 'None')
+                # The UMIs are interned as the duplicated UMIs (PCR duplicates) are
+                # common so they share the same object (faster hashing and comparisons)
+                umis[n] = sys.intern(aux_str(b, b"B3", 'None'))
+                names[n] = bam_get_qname(b)
+                n += 1
+            if n > 0:
+                yield {'tid': tid[:n], 'position': position[:n], 'start': starts[:n], 'end': ends[:n],
+                       'name': names[:n], 'mapq': mapq[:n], 'strand': strand[:n], 'x': x[:n],
+                       'y': y[:n], 'gene': genes[:n], 'umi': umis[:n]}
+            if ret == -1:
+                break
+    finally:
+        bam_destroy1(b)
@@ -0,0 +1,193 @@
+#cython: language_level=3, boundscheck=False, wraparound=False
+"""
+Low level kernels to cluster UMIs by hamming distance.
+UMIs are packed into 64 bits integers (3 bits per base, up to 21 bases,
+so the N bases can be packed too) with the first base in the most
+significant bits so that sorting the packed values is equivalent
+to sorting the UMIs
+"""
+
+import numpy as np
+from libc.stdint cimport uint64_t
+
+cdef extern from *:
+    int __builtin_popcountll(unsigned long long x) nogil
+
+# Maximum number of bases that can be packed in an UMI
+MAX_PACKED_LENGTH = 21
+
+cdef int BITS_PER_BASE = 3
+
+cdef uint64_t LOW_BITS = 0x1249249249249249ULL
+
+cdef inline int base_code(char base) nogil:
+    # the codes are ordered as the bases in the ASCII table
+    if base == b'A':
+        return 0
+    elif base == b'C':
+        return 1
+    elif base == b'G':
+        return 2
+    elif base == b'N':
+        return 3
+    elif base == b'T':
+        return 4
+    return -1
+
+cdef inline int packed_hamming(uint64_t a, uint64_t b) nogil:
+    # collapse every differing 3 bits base into its low bit and count them
+    cdef uint64_t x = a ^ b
+    x = (x | (x >> 1) | (x >> 2)) & LOW_BITS
+    return __builtin_popcountll(x)
+
+cdef inline Py_ssize_t find_root(Py_ssize_t[::1] parent, Py_ssize_t i) nogil:
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def encode_umis(umis):
+    """
+    Packs a list of UMIs into an array of 64 bits integers
+    :param umis: a list of UMIs (str)
+    :return: a NumPy uint64 array or None if any of the UMIs cannot
+             be packed (bases other than ACGTN, UMIs longer than
+             MAX_PACKED_LENGTH or of different lengths)
+    """
+    cdef Py_ssize_t n = len(umis)
+    cdef Py_ssize_t i, k, length
+    cdef Py_ssize_t first_length = -1
+    cdef bytes umi
+    cdef const char * bases
+    cdef int code
+    cdef uint64_t value
+    packed = np.empty(n, dtype=np.uint64)
+    cdef uint64_t[::1] packed_view = packed
+    for i in range(n):
+        try:
+            umi = umis[i].encode("ascii")
+        except UnicodeEncodeError:
+            return None
+        length = len(umi)
+        if first_length == -1:
+            first_length = length
+        if length == 0 or length > MAX_PACKED_LENGTH or length != first_length:
+            return None
+        bases = umi
+        value = 0
+        for k in range(length):
+            code = base_code(bases[k])
+            if code == -1:
+                return None
+            value = (value << BITS_PER_BASE) | code
+        packed_view[i] = value << (BITS_PER_BASE * (MAX_PACKED_LENGTH - length))
+    return packed
+
+cpdef int hamming_distance_packed(uint64_t a, uint64_t b):
+    """
+    Returns the hamming distance of two packed UMIs
+    """
+    return packed_hamming(a, b)
+
+def distance_matrix(uint64_t[::1] umis):
+    """
+    Computes the hamming distances of all the pairs of packed UMIs
+    :param umis: an array of packed UMIs
+    :return: the condensed distance matrix (as scipy.spatial.distance.pdist)
+    """
+    cdef Py_ssize_t n = umis.shape[0]
+    cdef Py_ssize_t i, j, k = 0
+    distances = np.empty(n * (n - 1) // 2, dtype=np.float64)
+    cdef double[::1] distances_view = distances
+    with nogil:
+        for i in range(n):
+            for j in range(i + 1, n):
+                distances_view[k] = packed_hamming(umis[i], umis[j])
+                k += 1
+    return distances
+
+def cluster_naive(uint64_t[::1] sorted_umis, int max_mm):
+    """
+    Clusters sorted packed UMIs that are consecutive and within
+    the given hamming distance
+    :param sorted_umis: a sorted array of packed UMIs
+    :param max_mm: the maximum hamming distance allowed
+    :return: an array with the cluster label of each UMI
+    """
+    cdef Py_ssize_t n = sorted_umis.shape[0]
+    cdef Py_ssize_t i
+    labels = np.zeros(n, dtype=np.intp)
+    cdef Py_ssize_t[::1] labels_view = labels
+    with nogil:
+        for i in range(1, n):
+            labels_view[i] = labels_view[i - 1]
+            if packed_hamming(sorted_umis[i - 1], sorted_umis[i]) > max_mm:
+                labels_view[i] += 1
+    return labels
+
+def pairwise_within_threshold(uint64_t[::1] umis, int max_mm):
+    """
+    Computes the adjacency list of the packed UMIs where two UMIs
+    are adjacent if they are within the given hamming distance
+    :param umis: an array of packed UMIs
+    :param max_mm: the maximum hamming distance allowed
+    :return: a tuple (offsets, neighbours) of arrays where the neighbours
+             of the UMI i (including itself) are neighbours[offsets[i]:offsets[i + 1]]
+    """
+    cdef Py_ssize_t n = umis.shape[0]
+    cdef Py_ssize_t i, j
+    offsets = np.zeros(n + 1, dtype=np.intp)
+    cdef Py_ssize_t[::1] offsets_view = offsets
+    # First pass to count the neighbours of each UMI
+    with nogil:
+        for i in range(n):
+            offsets_view[i + 1] += 1
+            for j in range(i + 1, n):
+                if packed_hamming(umis[i], umis[j]) <= max_mm:
+                    offsets_view[i + 1] += 1
+                    offsets_view[j + 1] += 1
+        for i in range(n):
+            offsets_view[i + 1] += offsets_view[i]
+    neighbours = np.empty(offsets_view[n], dtype=np.intp)
+    cdef Py_ssize_t[::1] neighbours_view = neighbours
+    cursor = offsets[:n].copy()
+    cdef Py_ssize_t[::1] cursor_view = cursor
+    # Second pass to fill in the neighbours
+    with nogil:
+        for i in range(n):
+            neighbours_view[cursor_view[i]] = i
+            cursor_view[i] += 1
+            for j in range(i + 1, n):
+                if packed_hamming(umis[i], umis[j]) <= max_mm:
+                    neighbours_view[cursor_view[i]] = j
+                    cursor_view[i] += 1
+                    neighbours_view[cursor_view[j]] = i
+                    cursor_view[j] += 1
+    return offsets, neighbours
+
+def cluster_hier(uint64_t[::1] umis, int max_mm):
+    """
+    Clusters packed UMIs with a single linkage criterion, UMIs
+    will be in the same cluster if they are connected by
+    pairs within the given hamming distance
+    :param umis: an array of packed UMIs
+    :param max_mm: the maximum hamming distance allowed
+    :return: an array with the cluster label of each UMI
+    """
+    cdef Py_ssize_t n = umis.shape[0]
+    cdef Py_ssize_t i, k, root_i, root_j
+    offsets, neighbours = pairwise_within_threshold(umis, max_mm)
+    cdef Py_ssize_t[::1] offsets_view = offsets
+    cdef Py_ssize_t[::1] neighbours_view = neighbours
+    labels = np.arange(n, dtype=np.intp)
+    cdef Py_ssize_t[::1] parent = labels
+    with nogil:
+        for i in range(n):
+            for k in range(offsets_view[i], offsets_view[i + 1]):
+                root_i = find_root(parent, i)
+                root_j = find_root(parent, neighbours_view[k])
+                if root_i != root_j:
+                    parent[root_j] = root_i
+        for i in range(n):
+            parent[i] = find_root(parent, i)
+    return labels
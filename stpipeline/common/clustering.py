@@ -5,13 +5,57 @@ molecular barcodes (UMIs) by hamming distance
 
 import numpy as np
 from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.spatial.distance import squareform
 from sklearn.cluster import AffinityPropagation
 from collections import defaultdict
 from stpipeline.common.cdistance import hamming_distance
+from stpipeline.common._umi_kernels import distance_matrix, cluster_naive, cluster_hier, \
+    pairwise_within_threshold
 import random
 from collections import Counter
 
 
+def packed_umis(molecular_barcodes):
+    """
+    Returns the UMIs as an array of packed UMIs (see _umi_kernels.encode_umis)
+    when they are given packed so the clustering
+    can be performed with the compiled kernels
+    :param molecular_barcodes: a list of UMIs
+    :return: a NumPy uint64 array or None if the UMIs are strings
+    """
+    if len(molecular_barcodes) > 0 and isinstance(molecular_barcodes[0], np.uint64):
+        return np.asarray(molecular_barcodes, dtype=np.uint64)
+    return None
+
+
+def pick_from_clusters(molecular_barcodes, labels):
+    """
+    Returns a random UMI from each of the clusters
+    :param molecular_barcodes: a list of UMIs
+    :param labels: the cluster label of each UMI
+    """
+    items = defaultdict(list)
+    for i, item in enumerate(labels):
+        items[item].append(i)
+    return [molecular_barcodes[random.choice(members)] for members in list(items.values())]
+
+
+def adjacent_umis(umis, allowed_mismatches):
+    """
+    Returns a dictionary with the UMIs (including itself)
+    that are within the allowed hamming distance of each UMI
+    :param umis: a list of unique UMIs
+    :param allowed_mismatches: the maximum hamming distance allowed
+    """
+    packed = packed_umis(umis)
+    if packed is None:
+        return {umi: [umi2 for umi2 in umis if hamming_distance(umi.encode("UTF-8"),
+                                                                umi2.encode("UTF-8")) \
+                      <= allowed_mismatches] for umi in umis}
+    offsets, neighbours = pairwise_within_threshold(packed, allowed_mismatches)
+    return {umi: [umis[j] for j in neighbours[offsets[i]:offsets[i + 1]]] for i, umi in enumerate(umis)}
+
+
 def countUMIHierarchical(molecular_barcodes,
                          allowed_mismatches,
                          method="single"):
@@ -34,6 +78,15 @@ def countUMIHierarchical(molecular_barcodes,
     if len(molecular_barcodes) <= 2:
         return countUMINaive(molecular_barcodes, allowed_mismatches)
 
+    packed = packed_umis(molecular_barcodes)
+    if packed is not None:
+        if method == "single":
+            flat_clusters = cluster_hier(packed, allowed_mismatches)
+        else:
+            linkage_cluster = linkage(distance_matrix(packed), method=method)
+            flat_clusters = fcluster(linkage_cluster, allowed_mismatches, criterion='distance')
+        return pick_from_clusters(molecular_barcodes, flat_clusters)
+
     # Distance computation function
     def d(coord):
         i, j = coord
@@ -42,14 +95,11 @@ def countUMIHierarchical(molecular_barcodes,
 
     # Create hierarchical clustering and obtain flat clusters at the distance given
     indices = np.triu_indices(len(molecular_barcodes), 1)
-    distance_matrix = np.apply_along_axis(d, 0, indices)
-    linkage_cluster = linkage(distance_matrix, method=method)
+    distances = np.apply_along_axis(d, 0, indices)
+    linkage_cluster = linkage(distances, method=method)
     flat_clusters = fcluster(linkage_cluster, allowed_mismatches, criterion='distance')
     # Retrieve the unique clustered UMIs
-    items = defaultdict(list)
-    for i, item in enumerate(flat_clusters):
-        items[item].append(i)
-    return [molecular_barcodes[random.choice(members)] for members in list(items.values())]
+    return pick_from_clusters(molecular_barcodes, flat_clusters)
 
 
 def countUMINaive(molecular_barcodes, allowed_mismatches):
@@ -69,6 +119,11 @@ def countUMINaive(molecular_barcodes, allowed_mismatches):
     :return: a list of unique UMIs
     :rtype: list
     """
+    packed = packed_umis(molecular_barcodes)
+    if packed is not None:
+        sorted_umis = np.sort(packed)
+        return pick_from_clusters(sorted_umis, cluster_naive(sorted_umis, allowed_mismatches))
+
     clusters_dict = {}
     nclusters = 0
     for i, molecular_barcode in enumerate(sorted(molecular_barcodes)):
@@ -131,9 +186,7 @@ def dedup_adj(molecular_barcodes, allowed_mismatches):
     c = Counter(molecular_barcodes)
 
     def get_adj_list_adjacency(umis):
-        return {umi: [umi2 for umi2 in umis if hamming_distance(umi.encode("UTF-8"),
-                                                                umi2.encode("UTF-8")) \
-                      <= allowed_mismatches] for umi in umis}
+        return adjacent_umis(umis, allowed_mismatches)
 
     def get_connected_components_adjacency(graph, Counter):
         found = list()
@@ -162,7 +215,7 @@ def dedup_adj(molecular_barcodes, allowed_mismatches):
             unique_umis += parent_umis
         return unique_umis
 
-    adj_list = get_adj_list_adjacency(c.keys())
+    adj_list = get_adj_list_adjacency(list(c.keys()))
     clusters = get_connected_components_adjacency(adj_list, c)
     unique_umis = reduce_clusters_adjacency(adj_list, clusters, c)
     return unique_umis
@@ -179,9 +232,8 @@ def dedup_dir_adj(molecular_barcodes, allowed_mismatches):
     c = Counter(molecular_barcodes)
 
     def get_adj_list_directional_adjacency(umis, counts):
-        return {umi: [umi2 for umi2 in umis if hamming_distance(umi.encode("UTF-8"),
-                                                                umi2.encode("UTF-8")) <= allowed_mismatches and
-                      counts[umi] >= (counts[umi2] * 2) - 1] for umi in umis}
+        return {umi: [umi2 for umi2 in adjacent if counts[umi] >= (counts[umi2] * 2) - 1]
+                for umi, adjacent in adjacent_umis(umis, allowed_mismatches).items()}
 
     def get_connected_components_adjacency(graph, Counter):
         found = list()
@@ -196,7 +248,7 @@ def dedup_dir_adj(molecular_barcodes, allowed_mismatches):
     def reduce_clusters_directional_adjacency(clusters):
         return [cluster.pop() for cluster in clusters]
 
-    adj_list = get_adj_list_directional_adjacency(c.keys(), c)
+    adj_list = get_adj_list_directional_adjacency(list(c.keys()), c)
     clusters = get_connected_components_adjacency(adj_list, c)
     unique_umis = reduce_clusters_directional_adjacency(clusters)
     return unique_umis
@@ -214,8 +266,12 @@ def affinity_umi_removal(molecular_barcodes, _):
     if len(molecular_barcodes) <= 2:
         return countUMINaive(molecular_barcodes, 0)
     words = np.asarray(molecular_barcodes)
-    lev_similarity = -1 * np.array([[hamming_distance(w1.encode("UTF-8"),
-                                                      w2.encode("UTF-8")) for w1 in words] for w2 in words])
+    packed = packed_umis(molecular_barcodes)
+    if packed is not None:
+        lev_similarity = -1 * squareform(distance_matrix(packed))
+    else:
+        lev_similarity = -1 * np.array([[hamming_distance(w1.encode("UTF-8"),
+                                                          w2.encode("UTF-8")) for w1 in words] for w2 in words])
     affprop = AffinityPropagation(affinity="precomputed", damping=0.5)
     affprop.fit(lev_similarity)
     unique_clusters = list()
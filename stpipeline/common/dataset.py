@@ -6,53 +6,246 @@ formats
 """
 import sys
 import os
+import random
+import multiprocessing
 import numpy as np
-from collections import defaultdict
-import pandas as pd
+from scipy.sparse import coo_matrix
 from stpipeline.common.clustering import *
-from stpipeline.common.unique_events_parser import parse_unique_events
+from stpipeline.common.unique_events_parser import parse_unique_events, transcripts_to_arrays
+from stpipeline.common._umi_kernels import encode_umis
 import logging
 import sys
 
+# BED strand symbols indexed by the strand values of the parsed transcripts
+STRANDS = (b"+", b"-")
 
-def computeUniqueUMIs(transcripts, umi_counting_offset, umi_allowed_mismatches, group_umi_func):
+# Size of the write buffer of the BED file
+BED_BUFFER_SIZE = 1 << 20
+
+# The number of genes sent at once to each worker process
+GENES_CHUNK_SIZE = 64
+
+# The UMI clustering functions (they use the compiled
+# kernels when the UMIs are given packed)
+UMI_CLUSTERING_FUNCTIONS = {"naive": countUMINaive,
+                            "hierarchical": countUMIHierarchical,
+                            "Adjacent": dedup_adj,
+                            "AdjacentBi": dedup_dir_adj,
+                            "Affinity": affinity_umi_removal}
+
+# Size of the write buffer of the counts matrix file
+TSV_BUFFER_SIZE = 1 << 20
+
+# The spots with fewer transcripts than this are processed with lists
+# of tuples as the overhead of creating NumPy arrays is bigger than the gain
+ARRAYS_MIN_TRANSCRIPTS = 512
+
+
+def computeUniqueUMIs(transcripts, umi_counting_offset, umi_allowed_mismatches, group_umi_func, rng=None):
     """ 
     Helper function to compute unique transcripts UMIs from
-    a given list of transcripts. The function using an offset (genomic coordinates) 
+    a given set of transcripts. The function using an offset (genomic coordinates) 
     where all UMIs will be grouped together by a grouping function and with a certain
     number of mismatches allowed (hamming distance)
+    :param transcripts: a dictionary of NumPy arrays (start, strand, umi, ...)
+    :param rng: the NumPy random generator to choose the unique transcripts
+    :return: the indexes (in the transcripts arrays) of the unique transcripts
     """
+    if rng is None:
+        rng = np.random.default_rng()
+    starts = transcripts["start"]
+    strands = transcripts["strand"]
+    umis = transcripts["umi"]
+    read_count = len(starts)
     # Sort transcripts by strand and start position
-    sorted_transcripts = sorted(transcripts, key=lambda x: (x[5], x[1]))
+    order = np.lexsort((starts, strands))
+    sorted_starts = starts[order]
+    sorted_strands = strands[order]
     # Group transcripts by strand and start-position allowing an offset
     # And then performs the UMI clustering in each group to finally
     # compute the gene count as the sum of the unique UMIs for each group (strand,start,offset)
-    grouped_transcripts = defaultdict(list)
     # TODO A probably better approach is to get the mean of all the start positions
     # and then make mean +- 300bp (user defined) a group to account for the library
     # size variability and then group the rest of transcripts normally by (strand, start, position).
+    # The starts are sorted within each strand so the differences are only
+    # negative where the strand changes, which is already a break
+    # (the first transcript always starts a group)
+    breaks = np.concatenate(([True], (np.diff(sorted_starts) > umi_counting_offset) |
+                                     (sorted_strands[1:] != sorted_strands[:-1])))
+    # Obtain the bounds of each group in the sorted transcripts
+    group_starts = np.flatnonzero(breaks)
+    group_ends = np.append(group_starts[1:], len(order))
+    sorted_umis = umis[order]
+    # There cannot be more unique transcripts than transcripts
+    unique_transcripts = np.empty(read_count, dtype=order.dtype)
+    total_unique = 0
+    for group_start, group_end in zip(group_starts.tolist(), group_ends.tolist()):
+        group_umis = sorted_umis[group_start:group_end]
+        group_indexes = order[group_start:group_end]
+        # Obtain the unique UMIs of the group and the UMI of each transcript
+        group_unique_umis, umi_inverse, umi_counts = np.unique(group_umis, return_inverse=True,
+                                                               return_counts=True)
+        # Compute unique UMIs by hamming distance
+        chosen_umis = clusterUniqueUMIs(group_unique_umis, umi_allowed_mismatches, group_umi_func) \
+            if len(group_unique_umis) > 1 else np.zeros(1, dtype=np.intp)
+        # Choose 1 random transcript for the clustered transcripts (by UMI)
+        # the transcripts ordered by UMI so the transcripts of each UMI are a range
+        umi_order = np.argsort(umi_inverse, kind="stable")
+        umis_begin = np.cumsum(umi_counts) - umi_counts
+        picks = umis_begin[chosen_umis] + rng.integers(0, umi_counts[chosen_umis])
+        unique_transcripts[total_unique:total_unique + len(picks)] = group_indexes[umi_order[picks]]
+        total_unique += len(picks)
+    return unique_transcripts[:total_unique]
+
+
+def computeUniqueUMIsList(transcripts, umi_counting_offset, umi_allowed_mismatches, group_umi_func):
+    """ 
+    Same as computeUniqueUMIs but for a list of transcripts tuples
+    (chrom, start, end, name, mapq, strand, umi) which is faster for
+    the spots with few transcripts (the common case in sparse data)
+    :param transcripts: a list of transcripts tuples
+    :return: the indexes (in the transcripts list) of the unique transcripts
+    """
+    if len(transcripts) == 1:
+        return [0]
+    # Sort transcripts by strand and start position
+    order = sorted(range(len(transcripts)), key=lambda i: (transcripts[i][5], transcripts[i][1]))
     unique_transcripts = list()
-    num_transcripts = len(transcripts)
-    for i in range(num_transcripts - 1):
-        current = sorted_transcripts[i]
-        nextone = sorted_transcripts[i + 1]
-        grouped_transcripts[current[6]].append(current)
-        if abs(current[1] - nextone[1]) > umi_counting_offset or current[5] != nextone[5]:
+    grouped_transcripts = dict()
+    last_strand = last_start = None
+    for i in order:
+        _, start, _, _, _, strand, umi = transcripts[i]
+        if grouped_transcripts and (strand != last_strand or start - last_start > umi_counting_offset):
             # A new group has been reached (strand, start-pos, offset)
-            # Compute unique UMIs by hamming distance
-            unique_umis = group_umi_func(list(grouped_transcripts.keys()), umi_allowed_mismatches)
-            # Choose 1 random transcript for the clustered transcripts (by UMI)
-            unique_transcripts += [random.choice(grouped_transcripts[u_umi]) for u_umi in unique_umis]
-            # Reset the container
-            grouped_transcripts = defaultdict(list)
-    # We process the last one and more transcripts if they were not processed
-    lastone = sorted_transcripts[num_transcripts - 1]
-    grouped_transcripts[lastone[6]].append(lastone)
-    unique_umis = group_umi_func(list(grouped_transcripts.keys()), umi_allowed_mismatches)
-    unique_transcripts += [random.choice(grouped_transcripts[u_umi]) for u_umi in unique_umis]
+            unique_transcripts += pickFromGroup(grouped_transcripts, umi_allowed_mismatches, group_umi_func)
+            grouped_transcripts = dict()
+        try:
+            grouped_transcripts[umi].append(i)
+        except KeyError:
+            grouped_transcripts[umi] = [i]
+        last_strand = strand
+        last_start = start
+    unique_transcripts += pickFromGroup(grouped_transcripts, umi_allowed_mismatches, group_umi_func)
     return unique_transcripts
 
 
+def pickFromGroup(grouped_transcripts, umi_allowed_mismatches, group_umi_func):
+    """
+    Helper function to cluster the UMIs of a group of transcripts
+    and choose 1 random transcript for each cluster
+    :param grouped_transcripts: a dictionary of UMI -> transcripts indexes
+    :return: the indexes of the chosen transcripts
+    """
+    if len(grouped_transcripts) == 1:
+        return [random.choice(members) for members in grouped_transcripts.values()]
+    unique_umis = sorted(grouped_transcripts)
+    return [random.choice(grouped_transcripts[unique_umis[i]]) for i in
+            clusterUniqueUMIs(unique_umis, umi_allowed_mismatches, group_umi_func).tolist()]
+
+
+def clusterUniqueUMIs(unique_umis, umi_allowed_mismatches, group_umi_func):
+    """
+    Helper function to cluster the unique UMIs of a group by hamming distance.
+    The UMIs of the group are packed so the clustering uses the compiled
+    kernels, only the groups with UMIs that cannot be packed (bases other
+    than ACGT or different lengths) are clustered as strings
+    :param unique_umis: the sorted unique UMIs (str) of the group
+    :return: the indexes (in unique_umis) of the UMIs chosen for each cluster
+    """
+    packed = encode_umis(unique_umis)
+    # The packed UMIs are sorted in the same order as the UMIs
+    if packed is not None:
+        return np.searchsorted(packed, group_umi_func(packed, umi_allowed_mismatches))
+    return np.searchsorted(np.asarray(unique_umis, dtype=object),
+                           group_umi_func(unique_umis, umi_allowed_mismatches))
+
+
+def _init_worker():
+    """
+    Re-seeds the random module generator of a worker process so
+    the forked processes do not share the same random sequence
+    (the NumPy generators are created with fresh entropy for each gene)
+    """
+    random.seed()
+
+
+def _process_gene(unique_event):
+    """
+    Helper function to compute the unique transcripts of
+    all the spots of a gene and format them as BED records
+    :param unique_event: a tuple (gene, spots, umi_cluster_algorithm,
+                         umi_counting_offset, umi_allowed_mismatches, diable_umi)
+                         where spots is a dictionary of spot coordinates -> transcripts
+    :return: a tuple (gene, [(spot coordinates, transcript count), ...],
+             BED records (bytes), number of discarded reads)
+    """
+    gene, spots, umi_cluster_algorithm, umi_counting_offset, \
+        umi_allowed_mismatches, diable_umi = unique_event
+    group_umi_func = UMI_CLUSTERING_FUNCTIONS[umi_cluster_algorithm]
+    rng = np.random.default_rng()
+    gene_bytes = gene.encode()
+    transcript_counts_by_spot = list()
+    bed_records = list()
+    discarded_reads = 0
+    for spot_coordinates, reads in list(spots.items()):
+        x,y = spot_coordinates
+        # Re-compute the read count accounting for duplicates using the UMIs
+        # Reads is a list of tuples (chrom, start, end, name, mapq, strand, umi)
+        # where chrom and name are bytes
+        # First:
+        # Get the original number of transcripts (reads)
+        read_count = len(reads)
+        if diable_umi:
+            unique_transcripts = range(read_count)
+        # Compute unique transcripts (based on UMI, strand and start position +- threshold)
+        elif read_count < ARRAYS_MIN_TRANSCRIPTS:
+            unique_transcripts = computeUniqueUMIsList(reads, umi_counting_offset,
+                                                       umi_allowed_mismatches, group_umi_func)
+        else:
+            unique_transcripts = computeUniqueUMIs(transcripts_to_arrays(reads), umi_counting_offset,
+                                                   umi_allowed_mismatches, group_umi_func, rng).tolist()
+        # The new transcript count
+        transcript_count = len(unique_transcripts)
+        assert transcript_count > 0 and transcript_count <= read_count
+        # Update the discarded reads count
+        discarded_reads += (read_count - transcript_count)
+        transcript_counts_by_spot.append((spot_coordinates, transcript_count))
+        # Format every unique transcript as BED (adding spot coordinate and gene name)
+        bed_records.append(b"".join(b"%s\t%d\t%d\t%s\t%d\t%s\t%s\t%d\t%d\n" %
+                                    (chrom, start, end, name, mapq, STRANDS[strand], gene_bytes, x, y)
+                                    for chrom, start, end, name, mapq, strand, _ in
+                                    map(reads.__getitem__, unique_transcripts)))
+    return gene, transcript_counts_by_spot, b"".join(bed_records), discarded_reads
+
+
+def _write_counts_matrix(counts_matrix, genes, spots, filename):
+    """
+    Helper function to write the counts matrix in TSV format (spots as rows
+    and genes as columns). Every row is formatted straight from the CSR
+    matrix so only one row is kept in memory at once
+    :param counts_matrix: the counts matrix (spots x genes) as a CSR matrix
+    :param genes: the names of the genes (columns)
+    :param spots: the coordinates (x,y) of the spots (rows)
+    :param filename: the path of the output file
+    """
+    # The counts are written as floats (5.0) when the matrix has missing (gene, spot)
+    # entries to keep the format of the filled data frame (NaN -> 0.0) written before
+    dense = counts_matrix.nnz == counts_matrix.shape[0] * counts_matrix.shape[1]
+    format_count = str if dense else lambda count: str(float(count))
+    zero = format_count(0)
+    row_fields = [zero] * counts_matrix.shape[1]
+    indptr = counts_matrix.indptr.tolist()
+    with open(filename, "wb", buffering=TSV_BUFFER_SIZE) as counts_handler:
+        counts_handler.write("\t{}\n".format("\t".join(genes)).encode())
+        for i, (x, y) in enumerate(spots):
+            row_genes = counts_matrix.indices[indptr[i]:indptr[i + 1]].tolist()
+            for j, count in zip(row_genes, counts_matrix.data[indptr[i]:indptr[i + 1]].tolist()):
+                row_fields[j] = format_count(count)
+            counts_handler.write("{0}x{1}\t{2}\n".format(x, y, "\t".join(row_fields)).encode())
+            for j in row_genes:
+                row_fields[j] = zero
+
+
 def createDataset(input_file,
                   qa_stats,
                   gff_filename=None,
@@ -62,7 +255,8 @@ def createDataset(input_file,
                   diable_umi=False,
                   output_folder=None,
                   output_template=None,
-                  verbose=True):
+                  verbose=True,
+                  threads=1):
     """
     The functions parses the reads in BAM format
     that have been annotated and demultiplexed (containing spatial barcode).
@@ -81,6 +275,7 @@ def createDataset(input_file,
     :param output_folder: path to place the output files
     :param output_template: the name of the dataset
     :param verbose: True if we can to collect the stats in the logger
+    :param threads: the number of processes to use to process the genes
     :type input_file: str
     :type gff_filename: str
     :type umi_cluster_algorithm: str
@@ -90,6 +285,7 @@ def createDataset(input_file,
     :type output_folder: str
     :type output_template: str
     :type verbose: bool
+    :type threads: integer
     :raises: RuntimeError,ValueError,OSError,CalledProcessError
     """
     logger = logging.getLogger("STPipeline")
@@ -105,94 +301,76 @@ def createDataset(input_file,
     else:
         filenameDataFrame = "stdata.tsv"
         filenameReadsBED = "reads.bed"
+    filenameDataFrame = os.path.join(output_folder, filenameDataFrame)
+    filenameReadsBED = os.path.join(output_folder, filenameReadsBED)
          
     # Some counters
     total_record = 0
     discarded_reads = 0
     
-    # Obtain the clustering function
-    if umi_cluster_algorithm == "naive":
-        group_umi_func = countUMINaive
-    elif umi_cluster_algorithm == "hierarchical":
-        group_umi_func = countUMIHierarchical
-    elif umi_cluster_algorithm == "Adjacent":
-        group_umi_func = dedup_adj
-    elif umi_cluster_algorithm == "AdjacentBi":
-        group_umi_func = dedup_dir_adj
-    elif umi_cluster_algorithm == "Affinity":
-        group_umi_func = affinity_umi_removal
-    else:
+    # Check the clustering function
+    if umi_cluster_algorithm not in UMI_CLUSTERING_FUNCTIONS:
         error = "Error creating dataset.\n " \
                 "Incorrect clustering algorithm {}".format(umi_cluster_algorithm)
         logger.error(error)
         raise RuntimeError(error)
  
-    # Containers needed to create the data frame
-    list_row_values = list()
-    list_indexes = list()   
+    # Containers needed to create the counts matrix (spots x genes)
+    # as (gene index, spot index, count) triplets
+    gene_to_idx = dict()
+    spot_to_idx = dict()
+    gene_indexes = np.empty(1024, dtype=np.int32)
+    spot_indexes = np.empty(1024, dtype=np.int32)
+    spot_counts = np.empty(1024, dtype=np.int32)
 
     # Parse unique events to generate the unique counts and the BED file
-    unique_events = parse_unique_events(input_file, gff_filename)
-    with open(os.path.join(output_folder, filenameReadsBED), "w") as reads_handler:
-        # this is the generator returning a dictionary with spots for each gene
-        for gene, spots in unique_events:
-            transcript_counts_by_spot = {}
-            for spot_coordinates, reads in list(spots.items()):
-                x,y = spot_coordinates
-                # Re-compute the read count accounting for duplicates using the UMIs
-                # Transcripts is the list of transcripts (chrom, start, end, clear_name, mapping_quality, strand, UMI)
-                # First:
-                # Get the original number of transcripts (reads)
-                reads = list(reads)
-                read_count = len(reads)
-                if not diable_umi:
-                    # Compute unique transcripts (based on UMI, strand and start position +- threshold)
-                    unique_transcripts = computeUniqueUMIs(reads, umi_counting_offset, 
-                                                           umi_allowed_mismatches, group_umi_func)
-                else:
-                    unique_transcripts = reads
-                # The new transcript count
-                transcript_count = len(unique_transcripts)
-                assert transcript_count > 0 and transcript_count <= read_count
+    unique_events = ((gene, spots, umi_cluster_algorithm, umi_counting_offset,
+                      umi_allowed_mismatches, diable_umi)
+                     for gene, spots in parse_unique_events(input_file, gff_filename, threads))
+    # The genes are processed in parallel when more than one thread is given
+    pool = multiprocessing.Pool(threads, initializer=_init_worker) if threads > 1 else None
+    processed_genes = pool.imap(_process_gene, unique_events, chunksize=GENES_CHUNK_SIZE) \
+        if pool is not None else map(_process_gene, unique_events)
+    try:
+        with open(filenameReadsBED, "wb",
+                  buffering=BED_BUFFER_SIZE) as reads_handler:
+            for gene, transcript_counts_by_spot, bed_records, gene_discarded_reads in processed_genes:
+                gene_index = gene_to_idx.setdefault(gene, len(gene_to_idx))
                 # Update the discarded reads count
-                discarded_reads += (read_count - transcript_count)
-                # Update read counts in the container (replace the list
-                # of transcripts for a number so it can be exported as a data frame)
-                transcript_counts_by_spot["{0}x{1}".format(x, y)] = transcript_count
-                # Write every unique transcript to the BED output (adding spot coordinate and gene name)
-                for read in unique_transcripts:
-                    reads_handler.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\t{7}\t{8}\n".format(read[0],
-                                                                                               read[1],
-                                                                                               read[2],
-                                                                                               read[3],
-                                                                                               read[4],
-                                                                                               read[5],
-                                                                                               gene,
-                                                                                               x,y)) 
-                # keep a counter of the number of unique events (spot - gene) processed
-                total_record += 1
-                
-            # Add spot and dict [gene] -> count to containers
-            list_indexes.append(gene)
-            list_row_values.append(transcript_counts_by_spot)
+                discarded_reads += gene_discarded_reads
+                for spot_coordinates, transcript_count in transcript_counts_by_spot:
+                    # Update read counts in the containers (grow them when they are full)
+                    if total_record == len(spot_counts):
+                        gene_indexes = np.concatenate((gene_indexes, np.empty_like(gene_indexes)))
+                        spot_indexes = np.concatenate((spot_indexes, np.empty_like(spot_indexes)))
+                        spot_counts = np.concatenate((spot_counts, np.empty_like(spot_counts)))
+                    gene_indexes[total_record] = gene_index
+                    spot_indexes[total_record] = spot_to_idx.setdefault(spot_coordinates, len(spot_to_idx))
+                    spot_counts[total_record] = transcript_count
+                    # keep a counter of the number of unique events (spot - gene) processed
+                    total_record += 1
+                # Write every unique transcript of the gene to the BED output
+                reads_handler.write(bed_records)
+    finally:
+        if pool is not None:
+            pool.terminate()
             
     if total_record == 0:
         error = "Error creating dataset, input file did not contain any transcript\n"
         logger.error(error)
         raise RuntimeError(error)
     
-    # Create the data frame
-    counts_table = pd.DataFrame(list_row_values, index=list_indexes)
-    counts_table.fillna(0, inplace=True)
-    # Transpose the dictionary to still get the spots as rows and genes as columns in the final tsv
-    counts_table = counts_table.T
+    # Create the counts matrix (spots x genes)
+    counts_matrix = coo_matrix((spot_counts[:total_record],
+                                (spot_indexes[:total_record], gene_indexes[:total_record])),
+                               shape=(len(spot_to_idx), len(gene_to_idx))).tocsr()
     
     # Compute some statistics
-    total_barcodes = len(counts_table.index)
-    total_transcripts = np.sum(counts_table.values, dtype=np.int32)
-    number_genes = len(counts_table.columns)
-    aggregated_spot_counts = counts_table.sum(axis=1).values
-    aggregated_gene_counts = (counts_table != 0).sum(axis=1).values
+    total_barcodes = counts_matrix.shape[0]
+    total_transcripts = np.sum(counts_matrix.data, dtype=np.int32)
+    number_genes = counts_matrix.shape[1]
+    aggregated_spot_counts = np.asarray(counts_matrix.sum(axis=1)).ravel()
+    aggregated_gene_counts = counts_matrix.getnnz(axis=1)
     max_genes_feature = aggregated_gene_counts.max()
     min_genes_feature = aggregated_gene_counts.min()
     max_reads_feature = aggregated_spot_counts.max()
@@ -204,18 +382,19 @@ def createDataset(input_file,
         
     # Print some statistics
     if verbose:
-        logger.info("Number of reads present: {}".format(total_transcripts))
-        logger.info("Number of unique events (gene-spot) present: {}".format(total_record))
-        logger.info("Number of unique genes present: {}".format(number_genes))
-        logger.info("Max number of genes over all spots: {}".format(max_genes_feature))
-        logger.info("Min number of genes over all spots: {}".format(min_genes_feature))
-        logger.info("Max number of reads over all spots: {}".format(max_reads_feature))
-        logger.info("Min number of reads over all spots: {}".format(min_reads_feature))
-        logger.info("Average number genes per spot: {}".format(average_genes_feature))
-        logger.info("Average number reads per spot: {}".format(average_reads_feature))
-        logger.info("Std. number genes per spot: {}".format(std_genes_feature))
-        logger.info("Std. number reads per spot: {}".format(std_reads_feature))
-        logger.info("Number of discarded reads (possible duplicates): {}".format(discarded_reads))
+        logger.info("\n".join([
+            "Number of reads present: {}".format(total_transcripts),
+            "Number of unique events (gene-spot) present: {}".format(total_record),
+            "Number of unique genes present: {}".format(number_genes),
+            "Max number of genes over all spots: {}".format(max_genes_feature),
+            "Min number of genes over all spots: {}".format(min_genes_feature),
+            "Max number of reads over all spots: {}".format(max_reads_feature),
+            "Min number of reads over all spots: {}".format(min_reads_feature),
+            "Average number genes per spot: {}".format(average_genes_feature),
+            "Average number reads per spot: {}".format(average_reads_feature),
+            "Std. number genes per spot: {}".format(std_genes_feature),
+            "Std. number reads per spot: {}".format(std_reads_feature),
+            "Number of discarded reads (possible duplicates): {}".format(discarded_reads)]))
         
     # Update the QA object
     qa_stats.reads_after_duplicates_removal = int(total_transcripts)
@@ -229,5 +408,6 @@ def createDataset(input_file,
     qa_stats.average_gene_feature = average_genes_feature
     qa_stats.average_reads_feature = average_reads_feature
      
-    # Write data frame to file
-    counts_table.to_csv(os.path.join(output_folder, filenameDataFrame), sep="\t", na_rep=0)       
+    # Write the counts matrix to file (spots as rows and genes as columns)
+    _write_counts_matrix(counts_matrix, list(gene_to_idx.keys()),
+                         list(spot_to_idx.keys()), filenameDataFrame)
@@ -6,6 +6,18 @@ import pysam
 import os
 import math
 
+# Maximum number of threads given to htslib to (de)compress a BAM file
+MAX_BAM_THREADS = 8
+
+
+def bam_threads(threads):
+    """
+    Returns the number of threads to use to (de)compress
+    a BAM file (pysam.AlignmentFile threads parameter)
+    :param threads: the number of CPU cores available
+    """
+    return max(1, min(MAX_BAM_THREADS, threads))
+
 
 def split_bam(input_bamfile_name, temp_dir, threads):
     """
@@ -20,7 +32,7 @@ def split_bam(input_bamfile_name, temp_dir, threads):
     # Index and open the input BAM
     pysam.index(input_bamfile_name,
                 os.path.join(temp_dir, '{0}.bai'.format(input_bamfile_name)))
-    input_bamfile = pysam.AlignmentFile(input_bamfile_name, mode='rb')
+    input_bamfile = pysam.AlignmentFile(input_bamfile_name, mode='rb', threads=bam_threads(threads))
     assert input_bamfile.check_index()
 
     output_file_names = {part: os.path.join(temp_dir,
@@ -29,7 +41,7 @@ def split_bam(input_bamfile_name, temp_dir, threads):
     # Open the output bam files
     output_bamfiles = {
         part: pysam.AlignmentFile(file_name, mode="wbu", template=input_bamfile) \
-        for part, file_name in output_file_names.iteritems()
+        for part, file_name in output_file_names.items()
     }
 
     # Split the BAM file
@@ -84,12 +96,13 @@ def convert_to_AlignedSegment(header, sequence, quality,
     return aligned_segment
 
 
-def merge_bam(merged_file_name, files_to_merge, ubam=False):
+def merge_bam(merged_file_name, files_to_merge, ubam=False, threads=1):
     """
     Function for merging partial BAM files into one.
     :param merged_file_name: name of the merged output bam file
     :param files_to_merge: list with names of the partial bam files to merge
     :param ubam: indicates unaligned bam file (True or False, default False)
+    :param threads: the number of threads to (de)compress the BAM files
     :returns: the total number of records
     """
     assert files_to_merge is not None and len(files_to_merge) > 0
@@ -97,10 +110,12 @@ def merge_bam(merged_file_name, files_to_merge, ubam=False):
     with pysam.AlignmentFile(files_to_merge[0], mode='rb',
                              check_sq=(not ubam)) as input_bamfile:
         merged_file = pysam.AlignmentFile(merged_file_name,
-                                          mode="wb", template=input_bamfile)
+                                          mode="wb", template=input_bamfile,
+                                          threads=bam_threads(threads))
         # Simply merges the BAM files and creates a counter of annotated records
         for file_name in files_to_merge:
-            input_bamfile = pysam.AlignmentFile(file_name, mode='rb', check_sq=(not ubam))
+            input_bamfile = pysam.AlignmentFile(file_name, mode='rb', check_sq=(not ubam),
+                                                threads=bam_threads(threads))
             for record in input_bamfile.fetch(until_eof=True):
                 merged_file.write(record)
                 num_ele += 1
@@ -12,6 +12,7 @@ import logging
 from stpipeline.common.dataset import createDataset
 from stpipeline.common.stats import Stats
 from stpipeline.common.utils import safeRemove
+from stpipeline.common.sam_utils import bam_threads
 
 
 def computeSaturation(nreads, 
@@ -23,7 +24,8 @@ def computeSaturation(nreads,
                       diable_umi,
                       expName,
                       temp_folder=None,
-                      saturation_points=None):
+                      saturation_points=None,
+                      threads=1):
     """
     It splits the input file up into sub-files containing
     random reads from the input file up to the saturation point. 
@@ -40,6 +42,7 @@ def computeSaturation(nreads,
     :param expName: the name of the dataset
     :param temp_folder: the path where to put the output files
     :param saturation_points: a list of saturation points to be used
+    :param threads: the number of threads to (de)compress the BAM files
     :type nreads: integer
     :type annotated_reads: str
     :type umi_cluster_algorithm: str
@@ -49,6 +52,7 @@ def computeSaturation(nreads,
     :type expName: str
     :type temp_folder: str
     :type saturation_points: list
+    :type threads: int
     :raises: RuntimeError
     """
     logger = logging.getLogger("STPipeline")
@@ -85,14 +89,15 @@ def computeSaturation(nreads,
         flag_read = "r"
         flag_write = "wh"
                  
-    annotated_sam = pysam.AlignmentFile(annotated_reads, flag_read)   
+    annotated_sam = pysam.AlignmentFile(annotated_reads, flag_read, threads=bam_threads(threads))
     # Generate sub-samples and SAM/BAM files for each saturation point
     for spoint in saturation_points:
         # Create a file for the sub sample point
         file_name = "subsample_{}{}".format(spoint, file_ext)
         if temp_folder is not None and os.path.isdir(temp_folder):
             file_name = os.path.join(temp_folder, file_name)
-        output_sam = pysam.AlignmentFile(file_name, flag_write, template=annotated_sam)
+        output_sam = pysam.AlignmentFile(file_name, flag_write, template=annotated_sam,
+                                         threads=bam_threads(threads))
         file_names[spoint] = file_name
         files[spoint] = output_sam
         # Generate a list of indexes in the sam file to extract sub samples 
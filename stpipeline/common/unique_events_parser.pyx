@@ -9,11 +9,32 @@ import multiprocessing
 import logging
 import pysam
 import operator
+import numpy as np
 from collections import defaultdict
 from pympler.asizeof import asizeof
 from stpipeline.common.utils import fileOk
+from stpipeline.common.sam_utils import bam_threads
 from stpipeline.common.stats import qa_stats
 from stpipeline.common.gff_reader import gff_lines
+from stpipeline.common._bam_iter import iterate_records
+
+def transcripts_to_arrays(list transcripts):
+    """
+    Converts a list of transcripts (chrom, start, end, clear_name, mapping_quality, strand, umi)
+    into a dictionary of parallel NumPy arrays (one per field) so the transcripts
+    of a spot can be processed with vectorized operations
+    :param transcripts: a list of transcripts tuples
+    :return: a dictionary with the keys chrom, start, end, name, mapq, strand and umi
+    """
+    chrom, start, end, name, mapq, strand, umi = zip(*transcripts)
+    return {'chrom': np.array(chrom, dtype=object),
+            'start': np.array(start, dtype=np.int32),
+            'end': np.array(end, dtype=np.int32),
+            'name': np.array(name, dtype=object),
+            'mapq': np.array(mapq, dtype=np.int32),
+            'strand': np.array(strand, dtype=np.int8),
+            'umi': np.array(umi, dtype=object)}
+
 
 class geneBuffer():
     """
@@ -101,19 +122,21 @@ class geneBuffer():
                                  "was not found in the annotation file\n".format(gene))
         return gene_end_coordinate
                 
-    def add_transcript(self, gene, spot_coordinates, transcript, position):
+    def add_transcript(self, gene, spot_coordinates, transcript, chromosome, position):
         """
         Adds a transcript to the gene buffer
         Parameters:
         :param gene: the name of the gene
         :param spot_coordinates: the spot coordinates as a (x,y) tuple
-        :param position: the transcript's lest most genomic coordinate
         :param transcript: the transcript information
             as a (chrom, start, end, clear_name, mapping_quality, strand, umi) tuple
+            where strand is 0 (forward) or 1 (reverse)
+        :param chromosome: the name of the transcript's chromosome
+        :param position: the transcript's lest most genomic coordinate
             (i.e. AlignedSegment.reference_start)
         """
         self.last_position = position
-        self.last_chromosome = transcript[0]
+        self.last_chromosome = chromosome
         cdef list new_reads_list
         # First try to add the "transcript" to the existing buffer
         try:
@@ -155,81 +178,67 @@ class geneBuffer():
                 # Remove the gene from the buffer
                 del self.buffer[gene]
                 
-def parse_unique_events(input_file, gff_filename=None):
+def parse_unique_events(input_file, gff_filename=None, threads=1):
     """
     This function parses the transcripts present in the filename given as input.
     It expects a coordinate sorted BAM file where the spot coordinates,
     gene and UMI are present as extra tags (optionally)
     Will yield a dictionary per gene with a spot coordinate tuple as keys
-    foreach gene yield: [spot] -> [(chrom, start, end, clear_name, mapping_quality, strand, umi), ... ]
+    foreach gene yield: [spot] -> [(chrom, start, end, name, mapq, strand, umi), ...]
+    (strand is 0 for forward and 1 for reverse and chrom and name are bytes)
     :param filename: the input file containing the annotated BAM records
     :param gff_filename: the gff file containing the gene coordinates (optional)
+    :param threads: the number of threads to decompress the BAM file
     """
     cdef object genes_buffer = geneBuffer(gff_filename) if gff_filename is not None else None
     cdef object genes_dict = dict()
-    cdef object rec
-    cdef str clear_name
+    cdef bytes clear_name
     cdef int mapping_quality
     cdef int start
     cdef int end
-    cdef str chrom
-    cdef str strand
+    cdef int position
+    cdef bytes chrom
+    cdef int strand
     cdef tuple transcript
     cdef tuple spot_coordinates
     cdef int x
     cdef int y
     cdef str gene
+    cdef str umi
     
     # Open the log file and open the bam file for reading
-    sam_file = pysam.AlignmentFile(input_file, "rb")
+    sam_file = pysam.AlignmentFile(input_file, "rb", threads=bam_threads(threads))
+    chromosomes = sam_file.references
+    # The chromosome names are encoded once so the BED records can be formatted as bytes
+    chromosomes_bytes = [chromosome.encode() for chromosome in chromosomes]
     
     # Parse the coordinate sorted bamfile record by record i.e. by genome 
-    # coordinate from first chromosome to last
-    for rec in sam_file.fetch(until_eof=True):
-
-        # get the info about the record from the bam file
-        clear_name = rec.query_name
-        mapping_quality = rec.mapping_quality
+    # coordinate from first chromosome to last (the records are read
+    # from the bam1_t structs in chunks of arrays)
+    for records in iterate_records(sam_file):
+        for tid, position, start, end, clear_name, mapping_quality, strand, x, y, gene, umi in \
+                zip(records['tid'].tolist(), records['position'].tolist(), records['start'].tolist(),
+                    records['end'].tolist(), records['name'], records['mapq'].tolist(),
+                    records['strand'].tolist(), records['x'].tolist(), records['y'].tolist(),
+                    records['gene'], records['umi']):
 
-        # Account for soft-clipped bases when retrieving the start/end coordinates
-        start = int(rec.reference_start - rec.query_alignment_start)
-        end = int(rec.reference_end + (rec.query_length - rec.query_alignment_end))
-        chrom = sam_file.getrname(rec.reference_id)
-        strand = "+"
-        if rec.is_reverse:
-            # We swap start and end if the transcript mapped to the reverse strand
-            strand = "-"
-            start, end = end, start
+            chrom = chromosomes_bytes[tid]
 
-        # Get TAGGD tags from the bam file
-        x,y,gene,umi = (-1,-1,'None','None')
-        for (k, v) in rec.tags:
-            if k == "B1":
-                x = int(v) ## The X coordinate
-            elif k == "B2":
-                y = int(v) ## The Y coordinate
-            elif k == "XF":
-                gene = str(v) ## The gene name
-            elif k == "B3":
-                umi = str(v) ## The UMI
+            # Create a new transcript and add it to the in memory gene_buffer dictionary
+            transcript = (chrom, start, end, clear_name, mapping_quality, strand, umi)
+            if gff_filename is not None:
+                genes_buffer.add_transcript(gene, (x,y), transcript, chromosomes[tid], position)
+                for g, t in list(genes_buffer.check_and_clear_buffer()):
+                    yield (g, t)
             else:
-                continue
-
-        # Create a new transcript and add it to the in memory gene_buffer dictionary
-        transcript = (chrom, start, end, clear_name, mapping_quality, strand, umi)
-        if gff_filename is not None:
-            genes_buffer.add_transcript(gene, (x,y), transcript, rec.reference_start)
-            for g, t in list(genes_buffer.check_and_clear_buffer()):
-                yield (g, t)
-        else:
-            try:
-                genes_dict[gene][(x,y)].append(transcript)
-            except KeyError:
-                try:    
-                    genes_dict[gene][(x,y)] = [transcript]
+                try:
+                    genes_dict[gene][(x,y)].append(transcript)
                 except KeyError:
-                    genes_dict[gene] = {(x,y):[transcript]}
-        
+                    try:    
+                        genes_dict[gene][(x,y)] = [transcript]
+                    except KeyError:
+                        genes_dict[gene] = {(x,y):[transcript]}
+
     # Close the bam file and yield the last gene(s)
     sam_file.close()
     if gff_filename is not None:
@@ -237,5 +246,5 @@ def parse_unique_events(input_file, gff_filename=None):
             yield (g, t)
     else:
         for (g,t) in list(genes_dict.items()):
-            yield (g,t)
+            yield (g, t)
 
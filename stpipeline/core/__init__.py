@@ -1 +1 @@
-#!/usr/bin/env python
\ No newline at end of file
+#!/usr/bin/env python3
\ No newline at end of file
@@ -7,6 +7,7 @@ import logging
 import os
 import pysam
 from stpipeline.common.utils import fileOk
+from stpipeline.common.sam_utils import bam_threads
 from stpipeline.common.stats import qa_stats
 import HTSeq
 
@@ -37,7 +38,8 @@ def count_reads_in_features(sam_filename,
                             samout,
                             include_non_annotated,
                             htseq_no_ambiguous,
-                            outputDiscarded):
+                            outputDiscarded,
+                            threads=1):
     """
     This is taken from the function count_reads_in_features() from the 
     script htseq-count in the HTSeq package version 0.70 
@@ -47,6 +49,7 @@ def count_reads_in_features(sam_filename,
     to the HTSeq team.
     The description of the parameters are the same as htseq-count.
     Two parameters were added to filter out what to write in the sam output
+    and the threads parameter sets the number of threads to compress the output
     
     The HTSEQ License
     HTSeq is free software: you can redistribute it and/or modify it under the terms of 
@@ -72,11 +75,13 @@ def count_reads_in_features(sam_filename,
     saminfile = pysam.AlignmentFile(sam_filename, flag_read)
     count_reads_in_features.samoutfile = pysam.AlignmentFile(samout,
                                                              flag_write,
-                                                             template=saminfile)
+                                                             template=saminfile,
+                                                             threads=bam_threads(threads))
     if outputDiscarded is not None:
         count_reads_in_features.samdiscarded = pysam.AlignmentFile(outputDiscarded,
                                                                    flag_write,
-                                                                   template=saminfile)
+                                                                   template=saminfile,
+                                                                   threads=bam_threads(threads))
     saminfile.close()
 
     # Counter of annotated records
@@ -198,7 +203,8 @@ def annotateReads(mappedReads,
                   mode,
                   strandness,
                   htseq_no_ambiguous,
-                  include_non_annotated):
+                  include_non_annotated,
+                  threads=1):
     """
     Annotates a file with mapped reads (BAM) using a modified 
     version of the htseq-count tool. It writes the annotated records to a file.
@@ -214,6 +220,7 @@ def annotateReads(mappedReads,
     :param include_non_annotated: true if we want to include 
     non annotated reads as __no_feature in the output
     :param outputFile: the name/path to the output file
+    :param threads: the number of threads to compress the output files
     :type mappedReads: str
     :type gtfFile: str
     :type outputFile: str
@@ -223,6 +230,7 @@ def annotateReads(mappedReads,
     :type htseq_no_ambiguos: boolean
     :type include_non_annotated: str
     :type outputFile: str
+    :type threads: int
     :raises: RuntimeError, ValueError
     """
 
@@ -245,7 +253,8 @@ def annotateReads(mappedReads,
                                             outputFile,
                                             include_non_annotated,
                                             htseq_no_ambiguous,
-                                            outputDiscarded)
+                                            outputDiscarded,
+                                            threads)
     except Exception as e:
         error = "Error during annotation. HTSEQ execution failed\n"
         logger.error(error)
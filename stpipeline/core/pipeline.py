@@ -14,6 +14,7 @@ from stpipeline.common.saturation import computeSaturation
 from stpipeline.version import version_number
 from taggd.io.barcode_utils import read_barcode_file
 from stpipeline.common.filterInputReads import InputReadsFilter
+from stpipeline.common.sam_utils import bam_threads
 import logging
 import argparse
 import sys
@@ -983,10 +984,13 @@ class Pipeline():
                 # NOTE: this will not be needed when STAR allows to chose the discarded
                 # reads format (BAM)
                 # We also need to set the NH tag to Null so to be able to run STAR again
-                infile = pysam.AlignmentFile(FILENAMES_DISCARDED["contaminated_discarded"], "rb")
-                out_unmap = pysam.AlignmentFile(FILENAMES["contaminated_clean"], "wb", template=infile)
+                infile = pysam.AlignmentFile(FILENAMES_DISCARDED["contaminated_discarded"], "rb",
+                                             threads=bam_threads(self.threads))
+                out_unmap = pysam.AlignmentFile(FILENAMES["contaminated_clean"], "wb", template=infile,
+                                                threads=bam_threads(self.threads))
                 temp_name = os.path.join(self.temp_folder, next(tempfile._get_candidate_names()))
-                out_map = pysam.AlignmentFile(temp_name, "wb", template=infile)
+                out_map = pysam.AlignmentFile(temp_name, "wb", template=infile,
+                                              threads=bam_threads(self.threads))
                 for sam_record in infile.fetch(until_eof=True):
                     try:
                         sam_record.set_tag("NH", None)
@@ -1087,8 +1091,9 @@ class Pipeline():
                 # Iterate the BAM file to set the gene name as the transcriptome's entry
                 flag_read = "rb"
                 flag_write = "wb"
-                infile = pysam.AlignmentFile(input_file, flag_read)
-                outfile = pysam.AlignmentFile(FILENAMES["annotated"], flag_write, template=infile)
+                infile = pysam.AlignmentFile(input_file, flag_read, threads=bam_threads(self.threads))
+                outfile = pysam.AlignmentFile(FILENAMES["annotated"], flag_write, template=infile,
+                                              threads=bam_threads(self.threads))
                 for rec in infile.fetch(until_eof=True):
                     # NOTE chrom may have to be trimmed to 250 characters max
                     chrom = infile.getrname(rec.reference_id).split()[0]
@@ -1105,7 +1110,8 @@ class Pipeline():
                                   FILENAMES_DISCARDED["annotated_discarded"] if self.keep_discarded_files else None,
                                   self.htseq_mode, self.strandness,
                                   self.htseq_no_ambiguous,
-                                  self.include_non_annotated)
+                                  self.include_non_annotated,
+                                  self.threads)
                 except Exception:
                     raise
 
@@ -1127,7 +1133,8 @@ class Pipeline():
                                   self.disable_umi,
                                   self.expName,
                                   self.temp_folder,
-                                  self.saturation_points)
+                                  self.saturation_points,
+                                  self.threads)
             except Exception:
                 raise
 
@@ -1,4 +1,4 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 """ 
 Unit-test for run-tests, it just tests that the pipeline runs and produces correct results
 """
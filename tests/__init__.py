@@ -1 +1 @@
-#!/usr/bin/python
+#!/usr/bin/python3
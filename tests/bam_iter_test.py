@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+"""
+Unit-test the package _bam_iter
+"""
+import unittest
+import os
+import shutil
+import tempfile
+import pysam
+import numpy as np
+from stpipeline.common._bam_iter import iterate_records
+
+def write_bam(filename, records):
+    # Writes the records (pysam.AlignedSegment parameters) to a BAM file
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'LN': 10000, 'SN': 'chr1'}, {'LN': 10000, 'SN': 'chr2'}]}
+    with pysam.AlignmentFile(filename, "wb", header=header) as bam_file:
+        for name, tid, pos, cigar, flag, mapq, tags in records:
+            rec = pysam.AlignedSegment()
+            rec.query_name = name
+            rec.reference_id = tid
+            rec.reference_start = pos
+            rec.cigarstring = cigar
+            rec.flag = flag
+            rec.mapping_quality = mapq
+            rec.query_sequence = "A" * rec.infer_query_length()
+            rec.query_qualities = pysam.qualitystring_to_array("I" * len(rec.query_sequence))
+            rec.set_tags(tags)
+            bam_file.write(rec)
+
+class TestBamIter(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="st_pipeline_test_bam_iter")
+        self.bam_file = os.path.join(self.tmp_dir, "records.bam")
+        write_bam(self.bam_file,
+                  [# Forward with soft-clipped bases and integer tags
+                   ("read1", 0, 100, "2S8M", 0, 255,
+                    [("B1", 10), ("B2", 20), ("XF", "GeneA"), ("B3", "ACGT")]),
+                   # Reverse with hard/soft-clipped bases and a string coordinate
+                   ("read2", 0, 200, "5H8M3S", 16, 255,
+                    [("B1", "11"), ("B2", 21), ("B3", "TTTT")]),
+                   # Forward without tags
+                   ("read3", 1, 50, "10M", 0, 30, [])])
+        self.unmapped_bam_file = os.path.join(self.tmp_dir, "unmapped.bam")
+        write_bam(self.unmapped_bam_file,
+                  [("read1", 0, 100, "10M", 0, 255, []),
+                   ("read2", -1, -1, "10M", 4, 0, [])])
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_iterate_records(self):
+        with pysam.AlignmentFile(self.bam_file, "rb") as sam_file:
+            chunks = list(iterate_records(sam_file))
+        self.assertTrue(len(chunks) == 1)
+        records = chunks[0]
+        self.assertTrue(list(records['tid']) == [0, 0, 1])
+        self.assertTrue(list(records['position']) == [100, 200, 50])
+        # The reverse strand swaps start and end
+        self.assertTrue(list(records['start']) == [98, 211, 50])
+        self.assertTrue(list(records['end']) == [108, 200, 60])
+        self.assertTrue(list(records['strand']) == [0, 1, 0])
+        self.assertTrue(list(records['mapq']) == [255, 255, 30])
+        self.assertTrue(list(records['name']) == [b"read1", b"read2", b"read3"])
+        self.assertTrue(list(records['x']) == [10, 11, -1])
+        self.assertTrue(list(records['y']) == [20, 21, -1])
+        self.assertTrue(list(records['gene']) == ["GeneA", "None", "None"])
+        self.assertTrue(list(records['umi']) == ["ACGT", "TTTT", "None"])
+
+    def test_iterate_records_chunks(self):
+        with pysam.AlignmentFile(self.bam_file, "rb") as sam_file:
+            chunks = list(iterate_records(sam_file, 2))
+        self.assertTrue([len(records['start']) for records in chunks] == [2, 1])
+        self.assertTrue(list(np.concatenate([records['start'] for records in chunks])) == [98, 211, 50])
+
+    def test_iterate_records_unmapped(self):
+        with pysam.AlignmentFile(self.unmapped_bam_file, "rb") as sam_file:
+            with self.assertRaises(ValueError):
+                list(iterate_records(sam_file))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,10 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 """ 
 Unit-test the package clustering
 """
 import unittest
 from stpipeline.common.clustering import *
+from stpipeline.common._umi_kernels import encode_umis, hamming_distance_packed
  
 class TestClustering(unittest.TestCase):
           
@@ -37,6 +38,15 @@ class TestClustering(unittest.TestCase):
                                     'BBBB',
                                     'CCCC',
                                     'ACCC']
+
+        self.molecular_barcodes4 = ['AAAA',
+                                    'TAAA',
+                                    'ACAA',
+                                    'ACCA',
+                                    'ACCC',
+                                    'CCCC',
+                                    'GGGG',
+                                    'AGGG']
          
     def test_naive_clustering(self):
         clusters = countUMINaive(self.molecular_barcodes1, 0)
@@ -126,6 +136,49 @@ class TestClustering(unittest.TestCase):
         clusters = dedup_dir_adj(self.molecular_barcodes3, 3)
         self.assertTrue(len(clusters) == 1)
         
+    def test_packed_umis(self):
+        self.assertTrue(encode_umis(self.molecular_barcodes3) is None)
+        self.assertTrue(encode_umis(['A' * 22]) is None)
+        self.assertTrue(encode_umis(['AAAA', 'AAXA']) is None)
+        self.assertTrue(encode_umis(['AAAA', 'AAA']) is None)
+        # The N bases are packed and count as mismatches
+        packed = encode_umis(['T' * 21, 'N' * 21])
+        self.assertTrue(hamming_distance_packed(packed[0], packed[1]) == 21)
+        packed = encode_umis(['NAAA', 'AAAN', 'NNNN', 'AAAA'])
+        self.assertTrue(hamming_distance_packed(packed[0], packed[1]) == 2)
+        self.assertTrue(hamming_distance_packed(packed[0], packed[2]) == 3)
+        self.assertTrue(hamming_distance_packed(packed[1], packed[3]) == 1)
+        self.assertTrue(list(np.argsort(encode_umis(['TNGA', 'NGAT', 'GATN', 'ATNG']))) == [3, 2, 1, 0])
+        packed = encode_umis(self.molecular_barcodes4)
+        self.assertTrue(len(packed) == len(self.molecular_barcodes4))
+        self.assertTrue(hamming_distance_packed(packed[0], packed[1]) == 1)
+        self.assertTrue(hamming_distance_packed(packed[0], packed[5]) == 4)
+        # Sorting the packed UMIs must sort the UMIs
+        self.assertTrue(list(np.argsort(packed, kind="stable")) == 
+                        list(np.argsort(self.molecular_barcodes4, kind="stable")))
+
+    def test_packed_clustering(self):
+        packed = list(encode_umis(self.molecular_barcodes4))
+        for mm, expected in [(0, 8), (1, 2), (3, 1)]:
+            clusters = countUMIHierarchical(packed, mm)
+            self.assertTrue(len(clusters) == expected)
+            self.assertTrue(len(countUMIHierarchical(self.molecular_barcodes4, mm)) == expected)
+            clusters = dedup_dir_adj(packed, mm)
+            self.assertTrue(len(clusters) == expected)
+        # Other linkage methods than single use the packed distance matrix
+        umis = ['AAAA', 'TAAA', 'ACAA', 'CCCC']
+        for mm in [0, 1, 3]:
+            self.assertTrue(len(countUMIHierarchical(list(encode_umis(umis)), mm, method="complete")) == 
+                            len(countUMIHierarchical(umis, mm, method="complete")))
+        self.assertTrue(len(countUMIHierarchical(encode_umis(umis), 1, method="complete")) == 3)
+        # The UMIs can also be given as a NumPy array
+        self.assertTrue(len(countUMIHierarchical(np.array(packed), 1)) == 2)
+        self.assertTrue(len(countUMIHierarchical(np.array(self.molecular_barcodes4, dtype=object), 1)) == 2)
+        for mm, expected in [(0, 8), (1, 5), (3, 4)]:
+            clusters = countUMINaive(packed, mm)
+            self.assertTrue(len(clusters) == expected)
+            self.assertTrue(set(clusters) <= set(packed))
+
     def test_affinity(self):
         # TODO must create test cases
         self.assertTrue(True)
@@ -0,0 +1,191 @@
+#! /usr/bin/env python3
+"""
+Unit-test the package dataset
+"""
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from stpipeline.common.dataset import computeUniqueUMIs, computeUniqueUMIsList, \
+    clusterUniqueUMIs, createDataset
+from stpipeline.common.clustering import countUMINaive, countUMIHierarchical, dedup_dir_adj
+from stpipeline.common.stats import Stats
+from tests.bam_iter_test import write_bam
+
+class TestDataset(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        # Transcripts of a spot (start, strand, umi) as parallel arrays
+        starts = [100, 105, 110, 100, 2000, 2010, 100, 100, 5000]
+        strands = [0, 0, 0, 0, 0, 0, 1, 1, 1]
+        umis = ['AAAAAAAAAA',
+                'AAAAAAAAAA',
+                'AAAAAAAAAT',
+                'CCCCCCCCCC',
+                'AAAAAAAAAA',
+                'AAAAAAAAAA',
+                'AAAAAAAAAA',
+                'AAAAAAAAAA',
+                'AAAAAAAAAA']
+        self.transcripts = {'chrom': np.array(['chr1'] * len(starts), dtype=object),
+                            'start': np.array(starts, dtype=np.int32),
+                            'end': np.array(starts, dtype=np.int32) + 50,
+                            'name': np.array(['read{}'.format(i) for i in range(len(starts))], dtype=object),
+                            'mapq': np.array([255] * len(starts), dtype=np.int32),
+                            'strand': np.array(strands, dtype=np.int8),
+                            'umi': np.array(umis, dtype=object)}
+        self.tmp_dir = tempfile.mkdtemp(prefix="st_pipeline_test_dataset")
+        # Annotated records (gene and spot coordinates) sorted by coordinate
+        self.bam_file = os.path.join(self.tmp_dir, "annotated.bam")
+        write_bam(self.bam_file,
+                  [("read1", 0, 100, "10M", 0, 255,
+                    [("B1", 1), ("B2", 1), ("XF", "geneA"), ("B3", "AAAAAAAA")]),
+                   ("read2", 0, 105, "10M", 0, 255,
+                    [("B1", 1), ("B2", 1), ("XF", "geneA"), ("B3", "AAAAAAAA")]),
+                   ("read3", 0, 110, "10M", 0, 255,
+                    [("B1", 1), ("B2", 1), ("XF", "geneA"), ("B3", "AAAAAAAT")]),
+                   ("read4", 0, 120, "10M", 0, 255,
+                    [("B1", 2), ("B2", 2), ("XF", "geneA"), ("B3", "CCCCCCCC")]),
+                   ("read5", 0, 500, "10M", 0, 255,
+                    [("B1", 1), ("B2", 1), ("XF", "geneB"), ("B3", "GGGGGGGG")]),
+                   ("read6", 0, 500, "10M", 16, 255,
+                    [("B1", 1), ("B2", 1), ("XF", "geneB"), ("B3", "GGGGGGGG")])])
+        # Only one gene in one spot (no missing gene-spot entries)
+        self.dense_bam_file = os.path.join(self.tmp_dir, "dense.bam")
+        write_bam(self.dense_bam_file,
+                  [("read5", 0, 500, "10M", 0, 255,
+                    [("B1", 1), ("B2", 1), ("XF", "geneB"), ("B3", "GGGGGGGG")]),
+                   ("read6", 0, 500, "10M", 16, 255,
+                    [("B1", 1), ("B2", 1), ("XF", "geneB"), ("B3", "GGGGGGGG")])])
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def create_dataset(self, input_file, diable_umi=False, threads=1):
+        # Runs createDataset and returns the stats and the lines of the output files
+        output_folder = tempfile.mkdtemp(dir=self.tmp_dir)
+        stats = Stats()
+        createDataset(input_file, stats, None, "naive", 1, 250, diable_umi,
+                      output_folder, "test", False, threads)
+        with open(os.path.join(output_folder, "test_stdata.tsv")) as counts_file:
+            counts = counts_file.read().splitlines()
+        with open(os.path.join(output_folder, "test_reads.bed")) as reads_file:
+            reads = reads_file.read().splitlines()
+        return stats, counts, reads
+
+    def test_compute_unique_umis(self):
+        # Groups: (+, 100-110) -> 3 UMIs, (+, 2000-2010) -> 1 UMI,
+        # (-, 100) -> 1 UMI, (-, 5000) -> 1 UMI
+        unique = computeUniqueUMIs(self.transcripts, 250, 0, countUMINaive)
+        self.assertTrue(len(unique) == 6)
+        unique = computeUniqueUMIs(self.transcripts, 250, 1, countUMINaive)
+        self.assertTrue(len(unique) == 5)
+        unique = computeUniqueUMIs(self.transcripts, 250, 1, countUMIHierarchical)
+        self.assertTrue(len(unique) == 5)
+        # A big offset merges the groups of each strand
+        unique = computeUniqueUMIs(self.transcripts, 10000, 1, countUMINaive)
+        self.assertTrue(len(unique) == 3)
+        # Every unique transcript is a different read
+        self.assertTrue(len(set(unique)) == len(unique))
+
+    def test_compute_unique_umis_packed(self):
+        # The UMIs of the groups are packed, lowercase UMIs cannot be packed
+        # and must give the same counts with the string clustering
+        for unique_umis in [['AAAAAAAAAA', 'AAAAAAAAAT', 'CCCCCCCCCC'],
+                            ['aaaaaaaaaa', 'aaaaaaaaat', 'cccccccccc']]:
+            chosen_umis = list(clusterUniqueUMIs(unique_umis, 1, countUMINaive))
+            self.assertTrue(len(chosen_umis) == 2)
+            self.assertTrue(chosen_umis[0] in [0, 1] and chosen_umis[1] == 2)
+        string_transcripts = dict(self.transcripts)
+        string_transcripts['umi'] = np.array([umi.lower() for umi in self.transcripts['umi']],
+                                             dtype=object)
+        for offset, mm in [(250, 0), (250, 1), (10000, 1), (10000, 10)]:
+            for group_umi_func in [countUMINaive, countUMIHierarchical, dedup_dir_adj]:
+                self.assertTrue(len(computeUniqueUMIs(self.transcripts, offset, mm, group_umi_func)) ==
+                                len(computeUniqueUMIs(string_transcripts, offset, mm, group_umi_func)))
+        # UMIs with N bases are packed too
+        n_transcripts = dict(self.transcripts)
+        n_transcripts['umi'] = np.array([umi.replace('T', 'N') for umi in self.transcripts['umi']],
+                                        dtype=object)
+        self.assertTrue(len(computeUniqueUMIs(n_transcripts, 250, 1, countUMIHierarchical)) == 5)
+        self.assertTrue(len(computeUniqueUMIs(n_transcripts, 250, 0, countUMIHierarchical)) == 6)
+
+    def test_compute_unique_umis_list(self):
+        # The list of tuples path gives the same counts as the arrays path
+        transcripts = list(zip(*[self.transcripts[key].tolist() for key in
+                                 ['chrom', 'start', 'end', 'name', 'mapq', 'strand', 'umi']]))
+        for offset, mm, expected in [(250, 0, 6), (250, 1, 5), (10000, 1, 3)]:
+            unique = computeUniqueUMIsList(transcripts, offset, mm, countUMINaive)
+            self.assertTrue(len(unique) == expected)
+            self.assertTrue(len(set(unique)) == len(unique))
+        unique = computeUniqueUMIsList(transcripts, 250, 1, countUMIHierarchical)
+        self.assertTrue(len(unique) == 5)
+        self.assertTrue(computeUniqueUMIsList(transcripts[:1], 250, 1, countUMINaive) == [0])
+
+    def test_compute_unique_umis_single(self):
+        transcripts = {key: value[:1] for key, value in self.transcripts.items()}
+        unique = computeUniqueUMIs(transcripts, 250, 1, countUMINaive)
+        self.assertTrue(list(unique) == [0])
+
+    def test_compute_unique_umis_pair(self):
+        # Same group and UMI -> one of them
+        transcripts = {key: value[[0, 1]] for key, value in self.transcripts.items()}
+        unique = computeUniqueUMIs(transcripts, 250, 1, countUMINaive)
+        self.assertTrue(len(unique) == 1 and unique[0] in [0, 1])
+        # Same group and different UMIs -> clustered
+        transcripts = {key: value[[1, 2]] for key, value in self.transcripts.items()}
+        unique = computeUniqueUMIs(transcripts, 250, 0, countUMINaive)
+        self.assertTrue(sorted(unique) == [0, 1])
+        unique = computeUniqueUMIs(transcripts, 250, 1, countUMINaive)
+        self.assertTrue(len(unique) == 1)
+        # Different groups (strand or start) -> both sorted by strand and start
+        transcripts = {key: value[[6, 0]] for key, value in self.transcripts.items()}
+        unique = computeUniqueUMIs(transcripts, 250, 1, countUMINaive)
+        self.assertTrue(list(unique) == [1, 0])
+        transcripts = {key: value[[4, 0]] for key, value in self.transcripts.items()}
+        unique = computeUniqueUMIs(transcripts, 250, 1, countUMINaive)
+        self.assertTrue(list(unique) == [1, 0])
+
+    def test_create_dataset(self):
+        for threads in [1, 2]:
+            stats, counts, reads = self.create_dataset(self.bam_file, threads=threads)
+            # Read 1-3 are duplicates (1 mismatch allowed) and read 5-6 are in different strands
+            self.assertTrue(stats.reads_after_duplicates_removal == 4)
+            self.assertTrue(stats.duplicates_found == 2)
+            self.assertTrue(stats.genes_found == 2)
+            self.assertTrue(stats.barcodes_found == 2)
+            # There are missing gene-spot entries so the counts are floats
+            self.assertTrue(counts == ["\tgeneA\tgeneB",
+                                       "1x1\t1.0\t2.0",
+                                       "2x2\t1.0\t0.0"])
+            self.assertTrue(len(reads) == 4)
+            duplicate = reads[0].split("\t")
+            self.assertTrue(duplicate[3] in ["read1", "read2", "read3"])
+            start = int(duplicate[1])
+            self.assertTrue(duplicate == ["chr1", str(start), str(start + 10), duplicate[3],
+                                          "255", "+", "geneA", "1", "1"])
+            self.assertTrue(reads[1:] == ["chr1\t120\t130\tread4\t255\t+\tgeneA\t2\t2",
+                                          "chr1\t500\t510\tread5\t255\t+\tgeneB\t1\t1",
+                                          "chr1\t510\t500\tread6\t255\t-\tgeneB\t1\t1"])
+
+    def test_create_dataset_no_umi(self):
+        stats, counts, reads = self.create_dataset(self.bam_file, diable_umi=True)
+        self.assertTrue(stats.reads_after_duplicates_removal == 6)
+        self.assertTrue(stats.duplicates_found == 0)
+        self.assertTrue(counts == ["\tgeneA\tgeneB",
+                                   "1x1\t3.0\t2.0",
+                                   "2x2\t1.0\t0.0"])
+        self.assertTrue([read.split("\t")[3] for read in reads] ==
+                        ["read1", "read2", "read3", "read4", "read5", "read6"])
+
+    def test_create_dataset_dense(self):
+        # No missing gene-spot entries so the counts are integers
+        stats, counts, reads = self.create_dataset(self.dense_bam_file)
+        self.assertTrue(counts == ["\tgeneB", "1x1\t2"])
+        self.assertTrue(len(reads) == 2)
+
+if __name__ == '__main__':
+    unittest.main()